@@ -9,14 +9,30 @@ import sys
 import time
 import math
 import asyncio
+from collections import deque
 import aiohttp
 import ssl
 import certifi
 import passiogo as pg
 from passiogo import Vehicle
+from route_eta import (
+    load_route_geometry,
+    anchor_bus,
+    track_bus,
+    update_segment_travel_times,
+    estimate_route_etas,
+    pick_calibration_stops,
+    out_of_sync,
+    calibration_factor,
+)
 
 PASSIO_GO_URL = "https://passiogo.com"
 VERBOSE = False
+FEET_TO_METERS = 0.3048
+SPEED_WINDOW_SECONDS = 60
+MAX_SPEED_GAP_SECONDS = 30
+ETA_SAMPLE_SIZE = 4
+ROUTE_REFRESH_CYCLES = 360
 def toIntInclNone(toInt):
     if toInt is None:
         return toInt
@@ -82,6 +98,8 @@ def create_connection(db_file):
     try:
         conn = sqlite3.connect(db_file)
         conn.execute("PRAGMA foreign_keys = ON")
+        #WAL lets the notebooks and db_snapshot.py read while we keep committing
+        conn.execute("PRAGMA journal_mode = WAL")
         print(f"We connected to: {db_file}")
         return conn
     except Exception as e:
@@ -123,6 +141,8 @@ def create_bus_log_table(conn):
         longitude          REAL,
         pax_load           REAL,
         arrived_stop_id    INTEGER, 
+        speed_prev_mps     REAL,
+        speed_1min_mps     REAL,
         
         FOREIGN KEY (bus_id) REFERENCES Buses (bus_id),
         FOREIGN KEY (route_myid) REFERENCES Routes (route_myid),
@@ -137,6 +157,98 @@ def create_bus_log_table(conn):
     except Exception as e:
         print(f"Error creating Bus_Logs table: {e}")
 
+#older databases were made before the speed columns existed so we add them and fill in the old rows once.
+#the columns and the backfill go in one transaction so if the backfill fails the columns aren't left behind
+#and the next run tries again
+def add_speed_columns(conn):
+    try:
+        c = conn.cursor()
+        c.execute("PRAGMA table_info(Bus_Logs)")
+        existing_cols = [row[1] for row in c.fetchall()]
+        missing_cols = [col for col in ("speed_prev_mps", "speed_1min_mps") if col not in existing_cols]
+        if not missing_cols:
+            return
+        c.execute("BEGIN")
+        for col in missing_cols:
+            c.execute(f"ALTER TABLE Bus_Logs ADD COLUMN {col} REAL")
+        print("Added speed columns to Bus_Logs. Backfilling old rows.")
+        backfill_bus_log_speeds(conn)
+        conn.commit()
+    except Exception as e:
+        print(f"Error adding speed columns to Bus_Logs: {e}", file=sys.stderr)
+        conn.rollback()
+
+#doesn't commit, add_speed_columns commits it together with the new columns
+def backfill_bus_log_speeds(conn):
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT log_id, bus_id, timestamp, latitude, longitude
+        FROM Bus_Logs
+        ORDER BY bus_id, timestamp, log_id
+        """
+    )
+    recent_positions = {}
+    updates = []
+    for (log_id, bus_id, timestamp, lat, lon) in c.fetchall():
+        speed_prev, speed_1min = update_bus_speeds(recent_positions, bus_id, timestamp, lat, lon)
+        if speed_prev is not None or speed_1min is not None:
+            updates.append((speed_prev, speed_1min, log_id))
+    if updates:
+        c.executemany(
+            "UPDATE Bus_Logs SET speed_prev_mps = ?, speed_1min_mps = ? WHERE log_id = ?",
+            updates
+        )
+    print(f"Backfilled speeds for {len(updates)} Bus_Logs rows.")
+
+#creates the log tables and runs the column migrations. python bus_log.py --migrate runs just this without
+#starting the collector so the notebooks can be pointed at an older database
+def migrate_database(conn):
+    create_bus_log_table(conn)
+    add_speed_columns(conn)
+    create_eta_log_table(conn)
+    add_eta_source_column(conn)
+
+#we keep the last minute of positions for each bus in memory so the speeds can be stored with the log row
+#instead of sorting the whole Bus_Logs table later on. returns (instantaneous speed, 1 min average speed) in m/s.
+#these match what bus_eta.ipynb used to compute: the instantaneous speed is the segment that ended at the previous
+#fix (not the one ending at this fix) and the 1 min average is every segment ending in the last 60 seconds.
+#a second fix in the same second gets the same speeds as the first one. like the notebook it still counts as a
+#position, so the next segment starts from it and the fix after it has no instantaneous speed (that segment has dt 0)
+def update_bus_speeds(recent_positions: dict, bus_id, timestamp, lat, lon):
+    try:
+        timestamp = int(timestamp)
+        lat = float(lat)
+        lon = float(lon)
+    except (ValueError, TypeError):
+        return None, None
+
+    history = recent_positions.setdefault(bus_id, deque())
+    speed_prev = None
+    seg_speed = None
+    dt = None
+    if history:
+        prev_ts, prev_lat, prev_lon, prev_seg_speed, prev_dt, last_speed_prev, last_speed_1min = history[-1]
+        dt = timestamp - prev_ts
+        if dt == 0:
+            history.append((timestamp, lat, lon, None, 0, last_speed_prev, last_speed_1min))
+            return last_speed_prev, last_speed_1min
+        if dt < 0:
+            return None, None
+        seg_speed = get_distance(prev_lat, prev_lon, lat, lon) * FEET_TO_METERS / dt
+        if prev_dt is not None and 0 < prev_dt <= MAX_SPEED_GAP_SECONDS:
+            speed_prev = prev_seg_speed
+
+    while history and history[0][0] <= timestamp - SPEED_WINDOW_SECONDS:
+        history.popleft()
+
+    window_speeds = [speed for (_ts, _lat, _lon, speed, _dt, _prev, _1min) in history if speed is not None]
+    if seg_speed is not None:
+        window_speeds.append(seg_speed)
+    speed_1min = sum(window_speeds) / len(window_speeds) if window_speeds else None
+    history.append((timestamp, lat, lon, seg_speed, dt, speed_prev, speed_1min))
+    return speed_prev, speed_1min
+
 #Creating the eta tables that we will use to store an eta per stop inside eahc bus log entry
 def create_eta_log_table(conn):
     sql_statement = """
@@ -145,6 +257,7 @@ def create_eta_log_table(conn):
         stop_id            INTEGER,
         eta_seconds        INTEGER,
         sort_order         INTEGER,
+        eta_source         TEXT DEFAULT 'api',
         
         PRIMARY KEY (log_id, sort_order),
         FOREIGN KEY (log_id) REFERENCES Bus_Logs (log_id) ON DELETE CASCADE,
@@ -159,6 +272,20 @@ def create_eta_log_table(conn):
     except Exception as e:
         print(f"Error creating ETA_Logs table: {e}", file=sys.stderr)
 
+#eta_source says if an ETA came from PassioGo ('api') or from route_eta.py ('local').
+#every row logged before the column existed came from the api so that is the default
+def add_eta_source_column(conn):
+    try:
+        c = conn.cursor()
+        c.execute("PRAGMA table_info(ETA_Logs)")
+        existing_cols = [row[1] for row in c.fetchall()]
+        if "eta_source" not in existing_cols:
+            c.execute("ALTER TABLE ETA_Logs ADD COLUMN eta_source TEXT DEFAULT 'api'")
+            print("Added eta_source column to ETA_Logs.")
+        conn.commit()
+    except Exception as e:
+        print(f"Error adding eta_source column to ETA_Logs: {e}", file=sys.stderr)
+
 #String parsing pax load
 def parse_pax_load(pax_load_str):
     if pax_load_str is None:
@@ -256,22 +383,11 @@ def get_stops_for_route(conn, route_myid):
         print(f"Error getting stops: {e}", file=sys.stderr)
         return []
 
-async def get_all_etas_and_paxload(conn, bus: Vehicle, system_id: int):
-    bus_id = bus.id
-    route_myid = bus.routeId
-    
-    if not route_myid:
-        print(f"  > Bus {bus_id} has no routeId. Skipping.")
-        return [], None 
-    
-    stops_on_route = get_stops_for_route(conn, route_myid)
-    if not stops_on_route:
-        print(f"Couldn't find stop list for route {route_myid} in DB.")
-        return [], None
-    
-    eta_results = [] 
-
-    stop_ids = [int(sid_tuple[0]) for sid_tuple in stops_on_route]
+#asks PassioGo for this bus's eta at each stop. invalid etas come back as 9999
+async def query_bus_etas(system_id: int, route_myid, bus_id, stop_ids: list[int]):
+    eta_results = []
+    if not stop_ids:
+        return eta_results
     try:
         start_time = time.time()
         eta_map = await fetch_etas_for_stops(system_id=system_id, route_id=route_myid, stop_ids=stop_ids, concurrency=len(stop_ids))
@@ -281,7 +397,7 @@ async def get_all_etas_and_paxload(conn, bus: Vehicle, system_id: int):
         print(f"Async ETA fetch failed: {e}")
         eta_map = {}
 
-    for (stop_id,) in stops_on_route:
+    for stop_id in stop_ids:
         
         eta_data = eta_map.get(str(stop_id))
         if eta_data is None:
@@ -292,7 +408,7 @@ async def get_all_etas_and_paxload(conn, bus: Vehicle, system_id: int):
             )
         
         if not eta_data:
-            eta_results.append((stop_id, 9999, None))
+            eta_results.append((stop_id, 9999, None, "api"))
             continue
 
         #print(eta_data) 
@@ -330,11 +446,76 @@ async def get_all_etas_and_paxload(conn, bus: Vehicle, system_id: int):
                     pax_load_str = (bus_eta_obj.get('solidEta') or {}).get('paxLoadS')
 
                 if eta_seconds is not None and eta_seconds >= 0:
-                    eta_results.append((stop_id, eta_seconds, pax_load_str))
+                    eta_results.append((stop_id, eta_seconds, pax_load_str, "api"))
                 else:
-                    eta_results.append((stop_id, 9999, None))
+                    eta_results.append((stop_id, 9999, None, "api"))
             except (ValueError, TypeError):
-                eta_results.append((stop_id, 9999, None))
+                eta_results.append((stop_id, 9999, None, "api"))
+
+    return eta_results
+
+async def get_all_etas_and_paxload(conn, bus: Vehicle, system_id: int, arrived_id: int = None,
+                                   route_geometries: dict = None, segment_times: dict = None, bus_progress: dict = None):
+    bus_id = bus.id
+    route_myid = bus.routeId
+    
+    if not route_myid:
+        print(f"  > Bus {bus_id} has no routeId. Skipping.")
+        return [], None 
+    
+    stops_on_route = get_stops_for_route(conn, route_myid)
+    if not stops_on_route:
+        print(f"Couldn't find stop list for route {route_myid} in DB.")
+        return [], None
+    
+    all_stop_ids = [int(sid_tuple[0]) for sid_tuple in stops_on_route]
+
+    #if we know where the bus is on its route we estimate the etas locally and only ask the api about a few stops
+    geometry = None
+    bus_state = None
+    local_etas = {}
+    timestamp = int(time.time())
+    if route_geometries is not None and bus_progress is not None:
+        route_key = toIntInclNone(route_myid)
+        if route_key not in route_geometries:
+            route_geometries[route_key] = load_route_geometry(conn, route_key)
+        geometry = route_geometries[route_key]
+        bus_state = bus_progress.setdefault(bus_id, {})
+        progress = track_bus(geometry, bus.latitude, bus.longitude, bus_state, arrived_id, timestamp)
+        if progress is not None:
+            local_etas = estimate_route_etas(geometry, progress, segment_times=segment_times)
+
+    if local_etas:
+        sampled = pick_calibration_stops(local_etas, ETA_SAMPLE_SIZE)
+        #stops behind the bus on a route that doesn't loop back have no local estimate so we still ask the api
+        stop_ids = sampled + [sid for sid in all_stop_ids if sid not in local_etas]
+    else:
+        sampled = []
+        stop_ids = all_stop_ids
+
+    eta_results = await query_bus_etas(system_id, route_myid, bus_id, stop_ids)
+    api_etas = {sid: eta for (sid, eta, _pax, _source) in eta_results if eta != 9999}
+
+    if local_etas and out_of_sync(local_etas, {sid: api_etas.get(sid) for sid in sampled}):
+        #we lost track of the bus so this cycle gets every stop from the api and the bus is placed again below
+        if VERBOSE:
+            print(f"Local ETAs for bus {bus_id} disagree with PassioGo, asking about every stop")
+        rest = [sid for sid in all_stop_ids if sid not in stop_ids]
+        eta_results += await query_bus_etas(system_id, route_myid, bus_id, rest)
+        api_etas = {sid: eta for (sid, eta, _pax, _source) in eta_results if eta != 9999}
+        local_etas = {}
+
+    if local_etas:
+        factor = calibration_factor(local_etas, api_etas)
+        if VERBOSE:
+            print(f"Local ETA calibration factor for bus {bus_id}: {factor:.2f}")
+        for stop_id, local_eta in local_etas.items():
+            if stop_id not in stop_ids:
+                eta_results.append((stop_id, int(round(local_eta * factor)), None, "local"))
+    elif bus_state is not None:
+        #the stop PassioGo says comes first tells us which leg of the route the bus is on
+        next_stop = min(api_etas, key=lambda sid: api_etas[sid]) if api_etas else None
+        anchor_bus(geometry, bus.latitude, bus.longitude, bus_state, next_stop, timestamp)
 
     if not eta_results:
         print("No ETA results")
@@ -346,7 +527,7 @@ async def get_all_etas_and_paxload(conn, bus: Vehicle, system_id: int):
         print(f"Sorted ETAs: {sorted_etas}")
 
     parsed_pax_load = None
-    for (_sid, _eta, pax_str) in sorted_etas:
+    for (_sid, _eta, pax_str, _source) in sorted_etas:
         if pax_str is None:
             continue
         p = parse_pax_load(pax_str)
@@ -356,12 +537,18 @@ async def get_all_etas_and_paxload(conn, bus: Vehicle, system_id: int):
             
     return sorted_etas, parsed_pax_load
 
-def log_bus_data(conn, bus: Vehicle, all_etas_list: list, arrived_id: int):
+def log_bus_data(conn, bus: Vehicle, all_etas_list: list, arrived_id: int, recent_positions: dict = None):
     """
     Inserts one row into Bus_Logs and multiple rows into ETA_Logs.
     """
     try:
         c = conn.cursor()
+        timestamp = int(time.time())
+        speed_prev, speed_1min = None, None
+        if recent_positions is not None:
+            speed_prev, speed_1min = update_bus_speeds(
+                recent_positions, bus.id, timestamp, bus.latitude, bus.longitude
+            )
 
         c.execute(
             """
@@ -375,13 +562,14 @@ def log_bus_data(conn, bus: Vehicle, all_etas_list: list, arrived_id: int):
             """
             INSERT INTO Bus_Logs (
                 timestamp, bus_id, route_myid, 
-                latitude, longitude, pax_load, arrived_stop_id
-            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                latitude, longitude, pax_load, arrived_stop_id,
+                speed_prev_mps, speed_1min_mps
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
             (
-                int(time.time()), bus.id, bus.routeId,
+                timestamp, bus.id, bus.routeId,
                 bus.latitude, bus.longitude, bus.paxLoad,
-                arrived_id
+                arrived_id, speed_prev, speed_1min
             )
         )
         
@@ -392,17 +580,17 @@ def log_bus_data(conn, bus: Vehicle, all_etas_list: list, arrived_id: int):
             return
 
         etas_to_insert = []
-        for i, (stop_id, eta_seconds, pax_str) in enumerate(all_etas_list):
+        for i, (stop_id, eta_seconds, pax_str, eta_source) in enumerate(all_etas_list):
             if eta_seconds != 9999: 
                 etas_to_insert.append(
-                    (new_log_id, stop_id, eta_seconds, i) 
+                    (new_log_id, stop_id, eta_seconds, i, eta_source) 
                 )
 
         if etas_to_insert:
             c.executemany(
                 """
-                INSERT INTO ETA_Logs (log_id, stop_id, eta_seconds, sort_order)
-                VALUES (?, ?, ?, ?)
+                INSERT INTO ETA_Logs (log_id, stop_id, eta_seconds, sort_order, eta_source)
+                VALUES (?, ?, ?, ?, ?)
                 """,
                 etas_to_insert
             )
@@ -432,9 +620,13 @@ async def main():
     if conn is None:
         sys.exit(1)
     
-    create_bus_log_table(conn)
-    create_eta_log_table(conn) 
+    migrate_database(conn)
     
+    recent_positions = {}
+    route_geometries = {}
+    bus_progress = {}
+    segment_state = {}
+    segment_times = update_segment_travel_times(conn, segment_state)
     SECONDS_PER_CYCLE = 10
     total_time_per_cycle = 0
     average_time_per_cycle = 0
@@ -442,6 +634,11 @@ async def main():
         loop_count = 1
         while True:
             timer = time.time()
+            #only reads the bus logs written since the last cycle
+            segment_times = update_segment_travel_times(conn, segment_state)
+            if loop_count % ROUTE_REFRESH_CYCLES == 0:
+                route_geometries.clear()
+                bus_progress.clear()
             active_buses = rutgers_system.getVehicles()
             if not active_buses:
                 print("No active buses found. Waiting for next cycle.")
@@ -461,20 +658,24 @@ async def main():
                 if VERBOSE:
                     print(f"\nProcessing Bus ID: {bus_to_log.id} (Name: {bus_to_log.name})")
                 try:
+                    arrived_id = find_arrived_stop(conn, bus_to_log.latitude, bus_to_log.longitude)
+                    
+                    if arrived_id is not None:
+                        if VERBOSE:
+                            print(f"STATUS: Bus has arrived at Stop ID: {arrived_id}")
+                    
                     sorted_etas, parsed_paxload = await get_all_etas_and_paxload(
                         conn, 
                         bus_to_log, 
-                        rutgers_system.id
+                        rutgers_system.id,
+                        arrived_id=arrived_id,
+                        route_geometries=route_geometries,
+                        segment_times=segment_times,
+                        bus_progress=bus_progress
                     )
                     
                     bus_to_log.paxLoad = parsed_paxload
                     
-                    arrived_id = find_arrived_stop(conn, bus_to_log.latitude, bus_to_log.longitude)
-                    
-                    if arrived_id is not None:
-                        if VERBOSE:
-                            print(f"STATUS: Bus has arrived at Stop ID: {arrived_id}")
-                    
                     first_valid_eta = next((eta for eta in sorted_etas if eta[1] != 9999), None)
                     
                     if first_valid_eta:
@@ -484,7 +685,7 @@ async def main():
                     else:
                         print(" Could not determine next stops (API returned no ETA for this bus).")
 
-                    log_bus_data(conn, bus_to_log, sorted_etas, arrived_id)
+                    log_bus_data(conn, bus_to_log, sorted_etas, arrived_id, recent_positions)
                         
                 except Exception as e:
                     print(f"\nAn error occurred during processing for bus {bus_to_log.id}: {e}", file=sys.stderr)
@@ -520,6 +721,13 @@ async def main():
 
 
 if __name__ == "__main__":
+    if "--migrate" in sys.argv:
+        conn = create_connection(DB_FILE)
+        if conn is None:
+            sys.exit(1)
+        migrate_database(conn)
+        conn.close()
+        sys.exit(0)
     try:
         asyncio.run(main())
     except Exception as e:
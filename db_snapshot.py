@@ -0,0 +1,175 @@
+"""
+Makes read only copies of rutgers_buses.db for the notebooks so long analysis queries don't fight with bus_log.py.
+The copy is done with the SQLite online backup API. bus_log.py keeps the database in WAL mode, so the backup's read
+doesn't block the collector's commits. Every snapshot is written to a temp file and swapped in at the end, so a
+reader always sees a whole snapshot and never one that is partway through being written.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import numpy as np
+
+DB_FILE = "rutgers_buses.db"
+SNAPSHOT_FILE = "rutgers_buses_snapshot.db"
+#-1 copies everything in one read transaction. smaller steps let a rollback journal database take writes in between,
+#but sqlite restarts the backup whenever the collector commits in the middle so it may never finish
+PAGES_PER_STEP = -1
+SECONDS_BETWEEN_SNAPSHOTS = 300
+BATCH_SIZE = 50000
+VERBOSE = False
+
+def take_snapshot(db_file=DB_FILE, snapshot_file=SNAPSHOT_FILE, pages=PAGES_PER_STEP):
+    """
+    Copies db_file into snapshot_file. Returns True if the snapshot was replaced.
+    """
+    source = None
+    target = None
+    start_time = time.time()
+
+    def progress(status, remaining, total):
+        if VERBOSE:
+            print(f"  > Snapshot copied {total - remaining} / {total} pages")
+
+    if not os.path.exists(db_file):
+        print(f"Error taking snapshot: {db_file} does not exist", file=sys.stderr)
+        return False
+
+    #every call gets its own temp file next to the snapshot so two snapshots at once can't write into the same one
+    fd, tmp_file = tempfile.mkstemp(
+        prefix=os.path.basename(snapshot_file) + ".",
+        suffix=".tmp",
+        dir=os.path.dirname(os.path.abspath(snapshot_file))
+    )
+    os.close(fd)
+
+    try:
+        source = sqlite3.connect(db_file)
+        target = sqlite3.connect(tmp_file)
+        source.backup(target, pages=pages, progress=progress)
+        #the copy keeps the WAL flag from the collector's database. a plain journal lets it be opened read only
+        target.execute("PRAGMA journal_mode = DELETE")
+        target.close()
+        target = None
+        #mkstemp makes the file private to us, give it normal permissions like the database has
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, snapshot_file)
+        if VERBOSE:
+            print(f"Snapshot of {db_file} written to {snapshot_file} in {time.time() - start_time:.2f} seconds.")
+        return True
+    except Exception as e:
+        print(f"Error taking snapshot of {db_file}: {e}", file=sys.stderr)
+        return False
+    finally:
+        if target:
+            target.close()
+        if source:
+            source.close()
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def run_snapshots(db_file=DB_FILE, snapshot_file=SNAPSHOT_FILE, interval=SECONDS_BETWEEN_SNAPSHOTS):
+    print(f"Taking a snapshot of {db_file} every {interval} seconds into {snapshot_file}")
+    try:
+        while True:
+            timer = time.time()
+            take_snapshot(db_file, snapshot_file)
+            sleep_duration = interval - (time.time() - timer)
+            if sleep_duration > 0:
+                time.sleep(sleep_duration)
+    except KeyboardInterrupt:
+        print("\n\nWe are stopping the snapshots")
+
+def open_snapshot(snapshot_file=SNAPSHOT_FILE):
+    """
+    Opens the snapshot read only. Takes a snapshot first if there isn't one yet.
+    """
+    if not os.path.exists(snapshot_file):
+        take_snapshot(snapshot_file=snapshot_file)
+    return sqlite3.connect(f"file:{snapshot_file}?mode=ro", uri=True)
+
+#turns one column of sqlite values into a numpy array using the declared column type.
+#integer columns that can hold NULL are always float64 so every batch of a column has the same dtype.
+#not_null should only be True for NOT NULL columns and INTEGER PRIMARY KEY rowid columns
+def column_to_numpy(values, decl_type, not_null=False):
+    decl_type = (decl_type or "").upper()
+    if "INT" in decl_type and not_null and not any(v is None for v in values):
+        return np.array(values, dtype=np.int64)
+    if "INT" in decl_type or "REAL" in decl_type or "FLOA" in decl_type or "DOUB" in decl_type:
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    if "CHAR" in decl_type or "TEXT" in decl_type or "CLOB" in decl_type:
+        return np.array(values, dtype=object)
+    #no declared type (like Stops.radius) so let numpy figure it out
+    try:
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    except (ValueError, TypeError):
+        return np.array(values, dtype=object)
+
+def iter_table_batches(table, snapshot_file=SNAPSHOT_FILE, columns=None, batch_size=BATCH_SIZE, as_arrow=False,
+                       conn=None, where=None, params=()):
+    """
+    Streams a table from the snapshot in batches. Each batch is a dict of column name -> numpy array,
+    or a pyarrow RecordBatch if as_arrow is True.
+    Pass conn to read through a connection that is already open, so every read sees the same snapshot even if a new
+    one is swapped in between them. where and params are added to the query as WHERE {where}.
+    """
+    if as_arrow:
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("as_arrow=True needs pyarrow. Install it with pip install pyarrow or use the numpy batches.")
+
+    own_conn = conn is None
+    if own_conn:
+        conn = open_snapshot(snapshot_file)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        if table not in [row[0] for row in c.fetchall()]:
+            raise ValueError(f"Table {table} is not in the snapshot")
+
+        c.execute(f'PRAGMA table_info("{table}")')
+        table_info = c.fetchall()
+        decl_types = {row[1]: row[2] for row in table_info}
+        #only a single INTEGER PRIMARY KEY is the rowid and can never be NULL. columns in a composite key
+        #like ETA_Logs (log_id, sort_order) still can, so they count as nullable unless they are NOT NULL
+        c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name = ?", (table,))
+        without_rowid = "WITHOUT ROWID" in (c.fetchone()[0] or "").upper()
+        pk_cols = [row for row in table_info if row[5]]
+        rowid_col = None
+        if len(pk_cols) == 1 and (pk_cols[0][2] or "").upper() == "INTEGER" and not without_rowid:
+            rowid_col = pk_cols[0][1]
+        not_null = {row[1]: bool(row[3]) or row[1] == rowid_col for row in table_info}
+        if columns is None:
+            columns = list(decl_types)
+        for col in columns:
+            if col not in decl_types:
+                raise ValueError(f"Column {col} is not in table {table}")
+
+        col_sql = ", ".join(f'"{col}"' for col in columns)
+        query = f'SELECT {col_sql} FROM "{table}"'
+        if where:
+            query += f" WHERE {where}"
+        c.execute(query, params)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            batch = {
+                col: column_to_numpy([row[i] for row in rows], decl_types[col], not_null[col])
+                for i, col in enumerate(columns)
+            }
+            if as_arrow:
+                yield pa.RecordBatch.from_arrays(
+                    [pa.array(batch[col], from_pandas=True) for col in columns],
+                    names=columns
+                )
+            else:
+                yield batch
+    finally:
+        if own_conn:
+            conn.close()
+
+if __name__ == "__main__":
+    run_snapshots()
@@ -0,0 +1,344 @@
+"""
+Local ETA estimator. It builds the route shape from Route_Stops and Stops, finds how far along the route a bus is
+and predicts when it gets to each stop ahead using old segment travel times from Bus_Logs. PassioGo only has to be
+asked about a few stops each cycle to calibrate the estimate and to catch when we lost track of the bus.
+"""
+import math
+import statistics
+import sys
+from collections import deque
+
+EARTH_RADIUS_METERS = 6371000.0
+#used for segments we have no trips for yet. the bus's own recent speed was tried here but it is mostly measured
+#while the bus crawls around stops, so it made the estimates a lot worse than a fixed speed
+DEFAULT_SPEED_MPS = 6.0
+MAX_SEGMENT_SECONDS = 30 * 60
+#only the latest trips over a segment count so the medians follow traffic and memory doesn't keep growing
+MAX_SEGMENT_SAMPLES = 200
+MAX_OFF_ROUTE_METERS = 400
+#once we know where the bus is we trust it further from the straight lines between stops since roads curve
+MAX_TRACKING_OFF_ROUTE_METERS = 800
+BACKTRACK_METERS = 30
+MIN_ADVANCE_METERS = 150
+MAX_BUS_SPEED_MPS = 25
+MIN_CALIBRATION_FACTOR = 0.5
+MAX_CALIBRATION_FACTOR = 2.0
+
+#turns lat/lon into x/y meters around a reference point. the routes are small enough that this is accurate
+def to_local_meters(lat, lon, ref_lat):
+    x = math.radians(lon) * EARTH_RADIUS_METERS * math.cos(math.radians(ref_lat))
+    y = math.radians(lat) * EARTH_RADIUS_METERS
+    return x, y
+
+def load_route_geometry(conn, route_myid):
+    """
+    Returns the stops of a route in order with their x/y position and the distance along the route to each one.
+    """
+    c = conn.cursor()
+    try:
+        c.execute(
+            """
+            SELECT rs.stop_id, rs.position_on_route, s.latitude, s.longitude
+            FROM Route_Stops rs
+            JOIN Stops s ON s.stop_id = rs.stop_id
+            WHERE rs.route_id_from_stop = ?
+            ORDER BY rs.position_on_route
+            """,
+            (route_myid,)
+        )
+        rows = [row for row in c.fetchall() if row[2] is not None and row[3] is not None]
+    except Exception as e:
+        print(f"Error loading route geometry for route {route_myid}: {e}", file=sys.stderr)
+        return None
+
+    if len(rows) < 2:
+        return None
+
+    ref_lat = sum(row[2] for row in rows) / len(rows)
+    stop_ids = []
+    points = []
+    cumulative = []
+    total = 0.0
+    for (stop_id, _pos, lat, lon) in rows:
+        point = to_local_meters(lat, lon, ref_lat)
+        if points:
+            total += math.dist(points[-1], point)
+        stop_ids.append(stop_id)
+        points.append(point)
+        cumulative.append(total)
+
+    return {
+        "route_myid": route_myid,
+        "stop_ids": stop_ids,
+        "points": points,
+        "cumulative": cumulative,
+        "length": total,
+        "ref_lat": ref_lat,
+        "is_loop": stop_ids[0] == stop_ids[-1],
+    }
+
+#the part of the route the bus could be on now, as (start, end) distances along the route. loop routes wrap around
+def progress_windows(geometry, progress, behind, ahead):
+    length = geometry["length"]
+    if not geometry["is_loop"]:
+        return [(max(0.0, progress - behind), min(length, progress + ahead))]
+    if behind + ahead >= length:
+        return [(0.0, length)]
+    start = (progress - behind) % length
+    end = start + behind + ahead
+    if end <= length:
+        return [(start, end)]
+    return [(start, length), (0.0, end - length)]
+
+def project_onto_route(geometry, lat, lon, windows=None, segments=None):
+    """
+    Finds the closest point on the route to the bus, only looking inside windows (distances along the route) and
+    segments (segment indexes) if they are given.
+    Returns (progress along the route in meters, meters the bus is away from the route) or (None, None).
+    """
+    bx, by = to_local_meters(lat, lon, geometry["ref_lat"])
+    points = geometry["points"]
+    cumulative = geometry["cumulative"]
+    if windows is None:
+        windows = [(0.0, geometry["length"])]
+    if segments is None:
+        segments = range(len(points) - 1)
+    best = None
+    for i in segments:
+        (ax, ay), (cx, cy) = points[i], points[i + 1]
+        seg_start, seg_end = cumulative[i], cumulative[i + 1]
+        seg_len = seg_end - seg_start
+        for (win_start, win_end) in windows:
+            lo = max(seg_start, win_start)
+            hi = min(seg_end, win_end)
+            if lo > hi:
+                continue
+            if seg_len == 0:
+                t = 0.0
+            else:
+                dx, dy = cx - ax, cy - ay
+                t = ((bx - ax) * dx + (by - ay) * dy) / (seg_len * seg_len)
+                t = min((hi - seg_start) / seg_len, max((lo - seg_start) / seg_len, t))
+            off_route = math.dist((bx, by), (ax + t * (cx - ax), ay + t * (cy - ay)))
+            if best is None or off_route < best[1]:
+                best = (seg_start + t * seg_len, off_route)
+    if best is None:
+        return None, None
+    return best
+
+#how far forward progress moved, negative if the bus looks like it went backwards
+def forward_distance(geometry, old_progress, new_progress):
+    delta = new_progress - old_progress
+    if geometry["is_loop"]:
+        length = geometry["length"]
+        delta %= length
+        if delta > length / 2:
+            delta -= length
+    return delta
+
+def anchor_bus(geometry, lat, lon, bus_state, next_stop_id=None, timestamp=None):
+    """
+    Places a bus we have no progress for yet. next_stop_id is the stop PassioGo says the bus gets to first, it picks
+    the right leg on routes that use the same road both ways. Returns the progress or None if the bus is off route.
+    """
+    if geometry is None or lat is None or lon is None:
+        return None
+    try:
+        lat = float(lat)
+        lon = float(lon)
+    except (ValueError, TypeError):
+        return None
+    stop_ids = geometry["stop_ids"]
+    progress, off_route = None, None
+    if next_stop_id is not None:
+        segments = [i for i in range(len(stop_ids) - 1) if stop_ids[i + 1] == next_stop_id]
+        if segments:
+            progress, off_route = project_onto_route(geometry, lat, lon, segments=segments)
+    #PassioGo's stop order doesn't always match position_on_route, then we just take the closest point
+    if progress is None or off_route > MAX_OFF_ROUTE_METERS:
+        progress, off_route = project_onto_route(geometry, lat, lon)
+    if progress is None or off_route > MAX_OFF_ROUTE_METERS:
+        bus_state.clear()
+        return None
+    bus_state.clear()
+    bus_state.update(route_myid=geometry["route_myid"], progress=progress, timestamp=timestamp)
+    return progress
+
+def track_bus(geometry, lat, lon, bus_state, arrived_stop_id=None, timestamp=None):
+    """
+    Moves a bus we already placed forward along the route. It can only move a little past where it could have driven
+    since the last fix and never backwards. Returns the progress or None if the bus needs to be anchored again.
+    """
+    if geometry is None or lat is None or lon is None:
+        return None
+    try:
+        lat = float(lat)
+        lon = float(lon)
+    except (ValueError, TypeError):
+        return None
+    if bus_state.get("route_myid") != geometry["route_myid"] or bus_state.get("progress") is None:
+        bus_state.clear()
+        return None
+    old_progress = bus_state["progress"]
+    dt = 0
+    if timestamp is not None and bus_state.get("timestamp") is not None:
+        dt = max(0, timestamp - bus_state["timestamp"])
+    windows = progress_windows(geometry, old_progress, BACKTRACK_METERS, MIN_ADVANCE_METERS + MAX_BUS_SPEED_MPS * dt)
+
+    progress = None
+    #if the bus is inside a stop's radius we know exactly where it is, as long as that stop is in reach
+    if arrived_stop_id is not None:
+        for k, stop_id in enumerate(geometry["stop_ids"]):
+            stop_progress = geometry["cumulative"][k]
+            if stop_id == arrived_stop_id and any(a <= stop_progress <= b for (a, b) in windows):
+                if progress is None or forward_distance(geometry, old_progress, stop_progress) < forward_distance(geometry, old_progress, progress):
+                    progress = stop_progress
+    if progress is None:
+        progress, off_route = project_onto_route(geometry, lat, lon, windows=windows)
+        if progress is None or off_route > MAX_TRACKING_OFF_ROUTE_METERS:
+            bus_state.clear()
+            return None
+
+    if forward_distance(geometry, old_progress, progress) < 0:
+        progress = old_progress
+    bus_state.update(progress=progress, timestamp=timestamp)
+    return progress
+
+def update_segment_travel_times(conn, segment_state):
+    """
+    Uses the arrived_stop_id column in Bus_Logs to get how long buses took between two stops in a row.
+    Only reads the rows logged since the last call, segment_state keeps where every bus was so it can pick up from
+    there. Returns {(route_myid, from_stop, to_stop): median seconds}, the same dict every call.
+    """
+    samples = segment_state.setdefault("samples", {})
+    times = segment_state.setdefault("times", {})
+    buses = segment_state.setdefault("buses", {})
+    c = conn.cursor()
+    try:
+        c.execute(
+            """
+            SELECT log_id, bus_id, route_myid, timestamp, arrived_stop_id
+            FROM Bus_Logs
+            WHERE log_id > ?
+            ORDER BY log_id
+            """,
+            (segment_state.get("last_log_id", 0),)
+        )
+        changed = set()
+        for (log_id, bus_id, route_myid, timestamp, arrived_stop_id) in c:
+            segment_state["last_log_id"] = log_id
+            bus = buses.setdefault(bus_id, {"last_stop": None, "last_arrival": None, "last_route": None, "current_stop": None})
+            #a bus stays inside the stop radius for a few logs so we only count the first one
+            if arrived_stop_id == bus["current_stop"]:
+                continue
+            bus["current_stop"] = arrived_stop_id
+            if arrived_stop_id is None or timestamp is None:
+                continue
+            if bus["last_stop"] is not None and route_myid == bus["last_route"] and arrived_stop_id != bus["last_stop"]:
+                travel = timestamp - bus["last_arrival"]
+                if 0 < travel <= MAX_SEGMENT_SECONDS:
+                    key = (route_myid, bus["last_stop"], arrived_stop_id)
+                    samples.setdefault(key, deque(maxlen=MAX_SEGMENT_SAMPLES)).append(travel)
+                    changed.add(key)
+            bus["last_stop"] = arrived_stop_id
+            bus["last_arrival"] = timestamp
+            bus["last_route"] = route_myid
+    except Exception as e:
+        print(f"Error loading segment travel times: {e}", file=sys.stderr)
+        return times
+
+    for key in changed:
+        times[key] = statistics.median(samples[key])
+    return times
+
+def estimate_route_etas(geometry, progress, segment_times=None):
+    """
+    Predicts seconds until the bus gets to every stop ahead of it on the route. progress comes from anchor_bus or
+    track_bus. Returns {stop_id: seconds}.
+    """
+    if geometry is None or progress is None:
+        return {}
+
+    if segment_times is None:
+        segment_times = {}
+
+    stop_ids = geometry["stop_ids"]
+    cumulative = geometry["cumulative"]
+    route_myid = geometry["route_myid"]
+    n_segments = len(stop_ids) - 1
+
+    def segment_seconds(i):
+        seg_len = cumulative[i + 1] - cumulative[i]
+        history = segment_times.get((route_myid, stop_ids[i], stop_ids[i + 1]))
+        if history is not None:
+            return history
+        return seg_len / DEFAULT_SPEED_MPS
+
+    if geometry["is_loop"] and geometry["length"] > 0:
+        progress %= geometry["length"]
+    seg_index = n_segments - 1
+    for i in range(n_segments):
+        if progress < cumulative[i + 1]:
+            seg_index = i
+            break
+    seg_len = cumulative[seg_index + 1] - cumulative[seg_index]
+    fraction = min(1.0, (progress - cumulative[seg_index]) / seg_len) if seg_len > 0 else 1.0
+
+    #finish the segment the bus is on, then go stop by stop. loop routes wrap back around to the start once
+    etas = {}
+    elapsed = (1.0 - fraction) * segment_seconds(seg_index)
+    i = seg_index + 1
+    steps = n_segments if geometry["is_loop"] else n_segments - seg_index
+    for _ in range(steps):
+        stop_id = stop_ids[i]
+        if stop_id not in etas or elapsed < etas[stop_id]:
+            etas[stop_id] = elapsed
+        if i == n_segments:
+            if not geometry["is_loop"]:
+                break
+            i = 0
+        elapsed += segment_seconds(i)
+        i += 1
+    return etas
+
+def pick_calibration_stops(local_etas, sample_size):
+    """
+    Picks which stops to ask PassioGo about. Always includes the next two stops, so out_of_sync can tell if the bus
+    already passed the one we think is next, and spreads the rest out along the route.
+    """
+    ordered = sorted(local_etas, key=lambda stop_id: local_etas[stop_id])
+    if len(ordered) <= sample_size:
+        return ordered
+    picked = ordered[:2]
+    rest = ordered[2:]
+    spread = sample_size - 2
+    picked += [rest[int((i + 1) * len(rest) / (spread + 1))] for i in range(spread)]
+    return picked
+
+def out_of_sync(local_etas, api_etas):
+    """
+    True if PassioGo says the bus gets to one of the sampled stops before the stop we think is next. That means we
+    placed the bus on the wrong leg or it passed a stop we missed, so it has to be anchored again.
+    """
+    if not local_etas or not api_etas:
+        return False
+    next_stop = min(local_etas, key=lambda stop_id: local_etas[stop_id])
+    if api_etas.get(next_stop) is None:
+        return False
+    return any(eta is not None and eta < api_etas[next_stop] for stop_id, eta in api_etas.items() if stop_id != next_stop)
+
+def calibration_factor(local_etas, api_etas):
+    """
+    Ratio between what PassioGo said and what we estimated for the sampled stops.
+    """
+    local_total = 0.0
+    api_total = 0.0
+    for stop_id, api_eta in api_etas.items():
+        local_eta = local_etas.get(stop_id)
+        if api_eta is None or local_eta is None:
+            continue
+        local_total += local_eta
+        api_total += api_eta
+    if local_total <= 0 or api_total <= 0:
+        return 1.0
+    return min(MAX_CALIBRATION_FACTOR, max(MIN_CALIBRATION_FACTOR, api_total / local_total))